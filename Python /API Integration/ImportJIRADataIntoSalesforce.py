@@ -3,33 +3,19 @@ from salesforce_bulk import SalesforceBulk, CsvDictsAdapter
 from utils.helpers import SalesforceRpts
 import os
 import sys
-import ast
 import pandas as pd
 from datetime import datetime
 
 def fetch_salesforce_data(sf_object, sf_query, keys):
     """
-    Fetches data from Salesforce using SalesforceBulk API.
+    Fetches data from Salesforce, refreshing the local snapshot with only the rows changed since the last run.
     :param sf_object: Salesforce object name
     :param sf_query: SOQL query to fetch data
     :param keys: Tuple of keys for dictionary creation
-    :return: List of dictionaries containing Salesforce data
+    :return: Generator of dictionaries containing Salesforce data
     """
-    bulk = SalesforceRpts.api_auth(SalesforceRpts())
-    job = bulk.create_query_job(sf_object, concurrency='Parallel')
-    batch = bulk.query(job, sf_query)
-    bulk.wait_for_batch(job, batch)
-    
-    result_list = []
-    for result in bulk.get_all_results_for_query_batch(batch, job, chunk_size=2048):
-        for row in result:
-            new_str = row.decode('utf-8')
-            new_list = ast.literal_eval(new_str)
-            result_dict = dict(zip(keys, new_list))
-            result_list.append(result_dict.copy())
-    
-    bulk.close_job(job)
-    return result_list
+    for row in SalesforceRpts().api_query_incremental(sf_object, sf_query):
+        yield {key: row.get(key) for key in keys}
 
 def main():
     # Salesforce queries and objects
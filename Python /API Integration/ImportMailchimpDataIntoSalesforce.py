@@ -31,6 +31,7 @@ import subprocess
 import dateutil.parser
 import logging
 from credentials import *
+from utils.helpers import BulkCsvDecoder
 from salesforce_bulk import SalesforceBulk, CsvDictsAdapter
 from simple_salesforce import Salesforce
 from salesforce_bulk.util import IteratorBytesIO
@@ -65,13 +66,10 @@ def get_salesforce_data(object_name, query):
         "MarketingRecycleLeadsStatus__c"
     )
     for result in bulk.get_all_results_for_query_batch(batch, job):
-        for row in result:
-            if row != b'Records not found for this query':
-                list_elements = row.decode('utf-8').replace('"', '').replace('\n', '').split(",")
-                values = tuple(list_elements[i] for i in range(len(keys)))
-                data.append(dict(zip(keys, values)))
+        for row in BulkCsvDecoder(result):
+            data.append({key: row.get(key) for key in keys})
     bulk.close_job(job)
-    return data[1:]
+    return data
 
 def post_members_to_list(**kwargs):
     payload = {
@@ -21,6 +21,7 @@ import requests, json, urllib.parse
 from salesforce_bulk import SalesforceBulk
 from simple_salesforce import Salesforce
 from credentials import *
+from utils.helpers import BulkCsvDecoder
 
 # Salesforce Report Class for Authentication and API Access
 class SalesforceRpts:
@@ -53,14 +54,10 @@ def get_salesforce_data(object_name, query):
     data = []
     keys = ("Id", "Email", "FirstName", "LastName", "Content__c", "MarketingRecycleLeadsStatus__c")
     for result in bulk.get_all_results_for_query_batch(batch, job):
-        for row in result:
-            if row != b'Records not found for this query':
-                list_elements = row.decode('utf-8').replace('"', '').replace('\n', '').split(",")
-                values = tuple(list_elements[i] for i in range(len(keys)))
-                data.append(dict(zip(keys, values)))
-    
+        for row in BulkCsvDecoder(result):
+            data.append({key: row.get(key) for key in keys})
     bulk.close_job(job)
-    return data[1:]  # Skip header
+    return data
 
 # Function to post members to Mailchimp list
 def post_members_to_list(**kwargs):
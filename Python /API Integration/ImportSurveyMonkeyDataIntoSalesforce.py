@@ -133,29 +133,17 @@ def get_survey_monkey_data():
 
     return collectors_messages_recipients_list
 
-def get_salesforce_data(sf_object, sf_query):
+def get_salesforce_data(sf_queries):
     """
-    Retrieves data from Salesforce using Bulk API.
-    :param sf_object: Salesforce object name (Lead, Contact)
-    :param sf_query: SOQL query to retrieve data
-    :return: List of Salesforce data
+    Retrieves data for several Salesforce queries concurrently using Bulk API.
+    :param sf_queries: List of (Salesforce object name, SOQL query) pairs
+    :return: List of Salesforce DataFrames per query, in the same order
     """
-    bulk = SalesforceRpts().api_auth()
-    job = bulk.create_query_job(sf_object, concurrency='Parallel')
-    batch = bulk.query(job, sf_query)
-    bulk.wait_for_batch(job, batch)
-    sf_data = []
-    keys = ("recipient_email", "recipient_id", "Id")
-
-    for result in bulk.get_all_results_for_query_batch(batch, job):
-        for row in result:
-            if row != b'Records not found for this query':
-                list_elements = row.decode('utf-8').replace('"', '').replace('\n', '').split(",")
-                values = (list_elements[0], list_elements[1], list_elements[2])
-                sf_data.append(dict(zip(keys, values)))
-
-    bulk.close_job(job)
-    return sf_data
+    fields = {"Email": "recipient_email", "Survey_Recipient_ID__c": "recipient_id", "Id": "Id"}
+    return [
+        sf_df.reindex(columns=list(fields)).rename(columns=fields)
+        for sf_df in SalesforceRpts().api_query_many(sf_queries, output='pandas')
+    ]
 
 def update_salesforce_data(sf_object, update_data):
     """
@@ -169,15 +157,14 @@ def update_salesforce_data(sf_object, update_data):
     bulk.wait_for_batch(job, batch)
     bulk.close_job(job)
 
-def merge_and_prepare_data(survey_data, sf_data):
+def merge_and_prepare_data(survey_data, salesforce_df):
     """
     Merges SurveyMonkey data with Salesforce data and prepares it for update.
     :param survey_data: Data retrieved from SurveyMonkey
-    :param sf_data: Data retrieved from Salesforce
+    :param salesforce_df: DataFrame retrieved from Salesforce
     :return: Merged and prepared data for update
     """
     survey_df = pd.DataFrame(survey_data)
-    salesforce_df = pd.DataFrame(sf_data)
     df_inner = pd.merge(salesforce_df, survey_df, on='recipient_email', how='inner')
     df_inner = df_inner[['Id', 'last_email_status', 'recipient_id_x']]
     df_inner = df_inner.rename(columns={'Id': 'Id', 'last_email_status': 'Survey_Monkey_Email_Click_Through_Rate__c', 'recipient_id_x': 'Survey_Recipient_ID__c'})
@@ -197,12 +184,11 @@ def main():
     sf_contact_query = "SELECT Email, Survey_Recipient_ID__c, Id FROM Contact WHERE Survey_Recipient_ID__c != '' AND IsDeleted = false"
 
     # Retrieve Salesforce data for leads and contacts
-    sf_lead_data = get_salesforce_data('Lead', sf_lead_query)
-    sf_contact_data = get_salesforce_data('Contact', sf_contact_query)
+    sf_lead_df, sf_contact_df = get_salesforce_data([('Lead', sf_lead_query), ('Contact', sf_contact_query)])
 
     # Merge and prepare data for Salesforce update
-    lead_update_data = merge_and_prepare_data(survey_data, sf_lead_data)
-    contact_update_data = merge_and_prepare_data(survey_data, sf_contact_data)
+    lead_update_data = merge_and_prepare_data(survey_data, sf_lead_df)
+    contact_update_data = merge_and_prepare_data(survey_data, sf_contact_df)
 
     # Update Salesforce leads
     if lead_update_data:
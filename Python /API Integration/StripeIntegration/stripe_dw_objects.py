@@ -1,13 +1,14 @@
 '''
 
 1. **Classes and Inheritance**: 
-   - **RawLogsPull**: Retrieves raw data from MySQL, removes Unicode characters, and consolidates Stripe event data.
+   - **RawLogsPull**: Retrieves raw data from MySQL, normalizes opted-in text fields, and consolidates Stripe event data.
    - **ChildObjects**: Extends RawLogsPull to extract specific details like subscription plans, items, and device-related data.
    - **DataInserter**: Inherits from ChildObjects to insert cleaned and structured data into MySQL tables based on object type.
 
 2. **Methods**:
-   - `remove_unicode`: Recursively removes Unicode from strings in dictionaries and lists.
+   - `normalize_fields`: Text fields normalized in place after decoding, so they fit the 3-byte utf8 DW columns.
    - `get_db_data`: Executes SQL statements to retrieve and parse data from MySQL.
+   - `iter_raw_batches`: Streams raw events through a server-side cursor and consolidates them batch by batch.
    - `consolidate_data`: Transforms raw Stripe event data into a structured format.
    - Methods in **ChildObjects** and **DataInserter** extract specific details and build additional data structures as needed.
 
@@ -16,6 +17,8 @@
 
 4. **Command-Line Execution**: 
    - Parses command-line arguments (`--object` and `--mintimestamp`) to specify which object's data to process and from which timestamp.
+   - `--stream` processes the events in batches of `--batchsize` rows, flushing per-table write buffers as they fill,
+     so memory stays flat however long the timestamp window is.
 
 '''
 
@@ -23,46 +26,39 @@ import collections
 import datetime
 import argparse
 import hashlib
-import json
+import re
 
-from helpers import MySQLRpts  # Assuming MySQLRpts is a helper class or module
+from helpers import MySQLRpts, JsonSerializer  # Assuming MySQLRpts is a helper class or module
 
 is_test = False  # Flag indicating whether this is a test run
 
 
 class RawLogsPull:
-    def __init__(self, data_object, min_timestamp):
+    # Fields normalized in place after decoding, matched by key at any depth; override to opt fields in or out
+    normalize_fields = dict.fromkeys(['description', 'email', 'name', 'nickname', 'statement_descriptor'],
+                                     JsonSerializer.bmp_text)
+
+    def __init__(self, data_object, min_timestamp, stream=False):
         """
         Initialize RawLogsPull with data object and minimum timestamp.
 
         :param data_object: Stripe object type (e.g., 'customer', 'subscription')
         :param min_timestamp: Minimum Unix timestamp to filter events
+        :param stream: Leave raw_data empty and read the events later through iter_raw_batches
         """
         self.data_object = data_object
         self.min_timestamp = min_timestamp
+        # Subscription events also carry their event_log type so ChildObjects.build_devices can reuse them
+        joined = self.data_object == 'subscription'
         self.get_stmt = (
-            "SELECT * "
-            "FROM stripe.event_object_raw "
-            f"WHERE object = '{self.data_object}' AND event_unixtimestamp >= {self.min_timestamp} "
-            "ORDER BY event_unixtimestamp "
+            "SELECT eor.*" + (", el.event_type, el.object_event_id " if joined else " ") +
+            "FROM stripe.event_object_raw eor " +
+            ("LEFT JOIN stripe.event_log el ON eor.id = el.id " if joined else "") +
+            f"WHERE eor.object = '{self.data_object}' AND eor.event_unixtimestamp >= {self.min_timestamp} "
+            "ORDER BY eor.event_unixtimestamp "
         )
-        self.raw_data = self.consolidate_data(self.get_db_data(self.get_stmt))
-
-    def remove_unicode(self, nested_dict):
-        """
-        Recursively remove Unicode characters from nested dictionaries and lists.
-
-        :param nested_dict: Dictionary or list containing Unicode strings
-        :return: Cleaned dictionary or list
-        """
-        if isinstance(nested_dict, str):
-            return str(nested_dict.encode('utf8'))
-        elif isinstance(nested_dict, collections.Mapping):
-            return dict(map(self.remove_unicode, nested_dict.items()))
-        elif isinstance(nested_dict, collections.Iterable):
-            return type(nested_dict)(map(self.remove_unicode, nested_dict))
-        else:
-            return nested_dict
+        self.raw_events = [] if stream else self.get_db_data(self.get_stmt)
+        self.raw_data = self.consolidate_data(self.raw_events)
 
     def get_db_data(self, stmt):
         """
@@ -71,10 +67,30 @@ class RawLogsPull:
         :param stmt: SQL statement to execute
         :return: Database query result as a list of dictionaries
         """
-        dt = MySQLRpts().get_select_data(stmt)
-        for items in dt:
-            items['data'] = json.loads(items.pop('data'))
-        return self.remove_unicode(dt)
+        return self.decode_rows(MySQLRpts().get_select_data(stmt))
+
+    def decode_rows(self, rows):
+        """
+        Parse the JSON data column of raw event rows and normalize normalize_fields in place.
+
+        :param rows: List of dictionaries read from stripe.event_object_raw
+        :return: List of dictionaries with decoded data
+        """
+        for items in rows:
+            items['data'] = JsonSerializer.normalize(JsonSerializer.loads(items.pop('data')), self.normalize_fields)
+        return rows
+
+    def iter_raw_batches(self, batch_size=5000, stmt=None, consolidate=True):
+        """
+        Stream raw events through a server-side cursor, decoding and consolidating one batch at a time.
+
+        :param batch_size: Number of raw event rows per batch
+        :param stmt: SQL statement to stream, defaults to the raw event query
+        :param consolidate: Yield consolidated events, or the decoded raw events when False
+        :return: Generator of lists of dictionaries
+        """
+        for rows in MySQLRpts().iter_select_data(stmt or self.get_stmt, batch_size=batch_size):
+            yield self.consolidate_data(self.decode_rows(rows)) if consolidate else self.decode_rows(rows)
 
     @staticmethod
     def consolidate_data(stripe_list_of_dicts):
@@ -119,26 +135,29 @@ class ChildObjects(RawLogsPull):
     Extend RawLogsPull to extract child objects from main data object.
     """
 
-    def __init__(self, data_object, min_timestamp):
+    def __init__(self, data_object, min_timestamp, stream=False):
         """
         Initialize ChildObjects with data object and minimum timestamp.
 
         :param data_object: Stripe object type (e.g., 'customer', 'subscription')
         :param min_timestamp: Minimum Unix timestamp to filter events
+        :param stream: Leave raw_data empty and read the events later through iter_raw_batches
         """
-        super().__init__(data_object, min_timestamp)
+        super().__init__(data_object, min_timestamp, stream)
 
-    def get_subscription_plan(self):
+    def get_subscription_plan(self, raw_data=None):
         """
         Extract subscription plan details from raw data.
 
+        :param raw_data: Consolidated events to read, defaults to self.raw_data
         :return: List of dictionaries containing subscription plan details
         """
         if self.data_object != 'subscription':
             return []
         else:
             try:
-                ss = [s['plan'] for s in self.raw_data if s['object'] == 'subscription']
+                ss = [s['plan'] for s in (self.raw_data if raw_data is None else raw_data)
+                      if s['object'] == 'subscription']
                 for sss in ss:
                     sss['updated_at'] = None
                     sss['plan_interval'] = sss.pop('interval')
@@ -147,10 +166,11 @@ class ChildObjects(RawLogsPull):
             except KeyError:
                 return []
 
-    def get_subscription_items(self):
+    def get_subscription_items(self, raw_data=None):
         """
         Extract subscription item details from raw data.
 
+        :param raw_data: Consolidated events to read, defaults to self.raw_data
         :return: List of dictionaries containing subscription item details
         """
         if self.data_object != 'subscription':
@@ -173,33 +193,29 @@ class ChildObjects(RawLogsPull):
                         'quantity': y['quantity'],
                         'subscription': y['subscription'],
                         'updated_at': None,
-                    } for si in self.raw_data for y in si['items']['data'] if si['object'] == 'subscription'
+                    } for si in (self.raw_data if raw_data is None else raw_data)
+                    for y in si['items']['data'] if si['object'] == 'subscription'
                 ]
             except KeyError:
                 return []
 
-    def build_devices(self):
+    def build_devices(self, raw_events=None):
         """
-        Build device-related data from raw data.
+        Build device-related data from the raw subscription events, skipping trial events and events without an
+        event_log entry.
 
+        :param raw_events: Decoded events joined to their event_log type, defaults to self.raw_events
         :return: List of dictionaries containing device-related details
         """
         if self.data_object != 'subscription':
             return []
         else:
             try:
-                device_stmt = (
-                    "SELECT eor.id, el.event_type, el.object_event_id, eor.event_unixtimestamp, eor.data "
-                    "FROM stripe.event_object_raw eor "
-                    "JOIN stripe.event_log el ON eor.id = el.id "
-                    f"WHERE eor.object = '{self.data_object}' "
-                    f"AND eor.event_unixtimestamp >= {self.min_timestamp} "
-                    "AND el.event_type not regexp 'trial' "
-                    "ORDER BY eor.event_unixtimestamp "
-                )
-                device_raw_data = self.get_db_data(device_stmt)
+                trial = re.compile('trial', re.IGNORECASE)
                 device_data = []
-                for xxx in device_raw_data:
+                for xxx in (self.raw_events if raw_events is None else raw_events):
+                    if xxx['event_type'] is None or trial.search(xxx['event_type']):
+                        continue
                     obj = {
                         'object': 'subscription_quantity',
                         'event_id': xxx['id'],
@@ -226,19 +242,23 @@ class DataInserter(ChildObjects):
     Insert extracted data into MySQL tables based on object type.
     """
 
-    def __init__(self, data_object, min_timestamp):
+    def __init__(self, data_object, min_timestamp, stream=False, batch_size=5000, flush_rows=20000):
         """
         Initialize DataInserter with data object and minimum timestamp.
 
         :param data_object: Stripe object type (e.g., 'customer', 'subscription')
         :param min_timestamp: Minimum Unix timestamp to filter events
+        :param stream: Process the events in batches instead of loading them all up front
+        :param batch_size: Number of raw event rows read per batch when streaming
+        :param flush_rows: Number of buffered rows per table that triggers a write when streaming
         """
-        super().__init__(data_object, min_timestamp)
-        # Combine all extracted data into raw_data
-        self.raw_data = self.raw_data \
-                        + self.get_subscription_plan() \
-                        + self.get_subscription_items() \
-                        + self.build_devices()
+        super().__init__(data_object, min_timestamp, stream)
+        if not stream:
+            # Combine all extracted data into raw_data
+            self.raw_data = self.raw_data \
+                            + self.get_subscription_plan() \
+                            + self.get_subscription_items() \
+                            + self.build_devices()
 
         # Define columns for each object type to insert into MySQL tables
         self.insert_cols = {
@@ -268,8 +288,12 @@ class DataInserter(ChildObjects):
         }
 
         # Insert data into corresponding MySQL tables
-        for k in self.insert_cols:
-            self.insert_data(k)
+        if stream:
+            self.stream_data(batch_size, flush_rows)
+        else:
+            routed = self.route_rows()
+            for k in self.insert_cols:
+                self.insert_data(k, routed[k])
 
     @staticmethod
     def parse_vals(value_to_parse):
@@ -284,7 +308,7 @@ class DataInserter(ChildObjects):
         elif not value_to_parse:
             return None
         elif isinstance(value_to_parse, collections.Mapping) or isinstance(value_to_parse, collections.Iterable):
-            return json.dumps(value_to_parse)
+            return JsonSerializer.dumps(value_to_parse)
         else:
             return value_to_parse
 
@@ -299,36 +323,75 @@ class DataInserter(ChildObjects):
             for records in self.raw_data
         ]
 
-    def insert_data(self, table):
+    def route_rows(self, raw_data=None):
+        """
+        Partition extracted records by target table in a single pass, projecting each record onto its table's
+        columns. Columns missing from a record are inserted as NULL.
+
+        :param raw_data: Extracted records to read, defaults to self.raw_data
+        :return: Dictionary of table name to a list of row tuples ordered like insert_cols
+        """
+        routed = {table: [] for table in self.insert_cols}
+        columns = {table: tuple(cols) for table, cols in self.insert_cols.items()}
+        parse_vals = self.parse_vals
+        for records in (self.raw_data if raw_data is None else raw_data):
+            table = records['object']
+            if table in routed:
+                routed[table].append(tuple(map(parse_vals, map(records.get, columns[table]))))
+        return routed
+
+    def insert_data(self, table, ins_data=None):
         """
         Insert data into MySQL table.
 
         :param table: Table name to insert data into
+        :param ins_data: Row tuples to insert, routed from self.raw_data when not given
         """
-        ins_data = [
-            {
-                k: self.parse_vals(v) for k, v in records.items()
-                if k in self.insert_cols[table] and table == records['object']
-            }
-            for records in self.raw_data
-        ]
-        ins_data = [xy for xy in ins_data if xy]
+        if ins_data is None:
+            ins_data = self.route_rows()[table]
         if ins_data:
-            ins_stmt = MySQLRpts().create_stmt('stripe.' + table, 'REPLACE', self.insert_cols[table])
             if is_test:
-                return ins_stmt, ins_data
+                return MySQLRpts().create_stmt('stripe.' + table, 'REPLACE', self.insert_cols[table]), \
+                       [dict(zip(self.insert_cols[table], row)) for row in ins_data]
             else:
-                MySQLRpts().insert_data(ins_stmt, ins_data)
+                MySQLRpts().bulk_load('stripe.' + table, ins_data, 'REPLACE', self.insert_cols[table])
+
+    def stream_data(self, batch_size=5000, flush_rows=20000):
+        """
+        Stream raw events in batches, routing each batch into per-table write buffers that are flushed to MySQL
+        whenever they reach flush_rows and once more at the end.
+
+        :param batch_size: Number of raw event rows read per batch
+        :param flush_rows: Number of buffered rows per table that triggers a write
+        """
+        buffers = {table: [] for table in self.insert_cols}
+
+        def route(records):
+            for table, rows in self.route_rows(records).items():
+                buffers[table].extend(rows)
+                if len(buffers[table]) >= flush_rows:
+                    self.insert_data(table, buffers[table])
+                    buffers[table] = []
+
+        for events in self.iter_raw_batches(batch_size, consolidate=False):
+            batch = self.consolidate_data(events)
+            route(batch + self.get_subscription_plan(batch) + self.get_subscription_items(batch)
+                  + self.build_devices(events))
+        for table, rows in buffers.items():
+            if rows:
+                self.insert_data(table, rows)
 
 if __name__ == '__main__':
     # Command-line argument parsing
     parser = argparse.ArgumentParser(description="Create DW Stripe table")
     parser.add_argument("--object", help="Object for insertion")
     parser.add_argument("--mintimestamp", help="Earliest timestamp value to filter for")
+    parser.add_argument("--stream", action="store_true", help="Process events in batches to keep memory flat")
+    parser.add_argument("--batchsize", type=int, default=5000, help="Raw event rows per batch when streaming")
     args = parser.parse_args()
 
     try:
         # Initialize DataInserter with command-line arguments
-        DataInserter(args.object, args.mintimestamp)
+        DataInserter(args.object, args.mintimestamp, stream=args.stream, batch_size=args.batchsize)
     except KeyError:
         pass  # Handle KeyError if necessary
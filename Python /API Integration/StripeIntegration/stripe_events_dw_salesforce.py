@@ -4,46 +4,30 @@
 # customer should be already be created in Salesforce via Zapier if none already exists
 # inserts into stripe schema in DW
 
-from helpers import SalesforceRpts, MySQLRpts
+from helpers import SalesforceRpts, MySQLRpts, JsonSerializer
 from datetime import datetime
 import credentials
-import collections
 import subprocess
 import requests
-import decimal
 import hashlib
 import stripe
 import boto3
-import json
 import copy
 import sys
 
 is_test = False
 
 
-class DecimalEncoder(json.JSONEncoder):
-    """
-    helper class to convert a DynamoDB item to json
-    """
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            if o % 1 > 0:
-                return float(o)
-            else:
-                return int(o)
-        return super(DecimalEncoder, self).default(o)
-
-
 def get_all_dynamo_data(table_name):
     dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
     table = dynamodb.Table(table_name)
     response = table.scan()
-    page_1 = [json.loads(json.dumps(i, cls=DecimalEncoder)) for i in response['Items']]
+    page_1 = [JsonSerializer.plain(i) for i in response['Items']]
     all_pages = []
     while 'LastEvaluatedKey' in response:
         response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
         for i in response['Items']:
-            all_pages.append(json.loads(json.dumps(i, cls=DecimalEncoder)))
+            all_pages.append(JsonSerializer.plain(i))
     return all_pages if all_pages else page_1
 
 # get summary data
@@ -147,39 +131,28 @@ def prep_data(list_of_dicts, destination='salesforce'):
     return dt_insert
 
 mysql_data = prep_data(data, destination='mysql')
-ins_stmt = MySQLRpts().create_stmt('stripe.event_log', col_list=mysql_data[0].keys())
-MySQLRpts().insert_data(ins_stmt, mysql_data)
+MySQLRpts().bulk_load('stripe.event_log', mysql_data, col_list=mysql_data[0].keys())
 max_date = MySQLRpts().get_select_data("select from_unixtime(%s)" % sorted([dico['created'] for dico in data],
                                                                            reverse=True)[0])[0].values()[0]
 MySQLRpts().exec_simple('insert into fed.stripe_event_log_fed select * from stripe.event_log;')
 sf_data = prep_data(data, destination='salesforce')
 
+# a batch Salesforce rejects as a whole raises before any staging rows are deleted; events rejected row by row
+# are kept in stripe_stage so the next run retries them
+rejected_events = set()
 if sf_data:
-    SalesforceRpts().api_upsert('Skylark_Subscription_Event__c', 'Event_ID__c', sf_data)
+    sf_results = SalesforceRpts().api_upsert('Skylark_Subscription_Event__c', 'Event_ID__c', sf_data)
+    rejected_events = {failure['row']['Event_ID__c'] for result in sf_results for failure in result['failed']}
 
 # get raw log object data, insert into DW, truncate Dynamo staging table
-data_obj_raw = get_all_dynamo_data('stripe_object_stage')
-
-
-def remove_unicode(nested_dict):
-    if isinstance(nested_dict, basestring):
-        return str(nested_dict.encode('utf8'))
-    elif isinstance(nested_dict, collections.Mapping):
-        return dict(map(remove_unicode, nested_dict.iteritems()))
-    elif isinstance(nested_dict, collections.Iterable):
-        return type(nested_dict)(map(remove_unicode, nested_dict))
-    else:
-        return nested_dict
-
-data_obj = [remove_unicode(stg) for stg in data_obj_raw]
+data_obj = get_all_dynamo_data('stripe_object_stage')
 for xx in data_obj:
     xx['event_unixtimestamp'] = xx.pop('created')
     xx['event_datetime'] = datetime.fromtimestamp(xx['event_unixtimestamp']).strftime('%Y-%m-%d %H:%M:%S')
     for k, v in xx.items():
-        xx[k] = str(xx.pop(k)) if k != 'data' else json.dumps(xx.pop(k))
+        xx[k] = str(v) if k != 'data' else JsonSerializer.dumps(v)
 
-ins_stmt_obj = MySQLRpts().create_stmt('stripe.event_object_raw', col_list=data_obj[0].keys())
-MySQLRpts().insert_data(ins_stmt_obj, data_obj)
+MySQLRpts().bulk_load('stripe.event_object_raw', data_obj, col_list=data_obj[0].keys())
 
 # call file to create object tables
 min_event = min(set((int(x['event_unixtimestamp'])-(2*60*60)) for x in data_obj))
@@ -203,10 +176,11 @@ def delete_dynamo_item(table, primary_col, primary_key, data_type='S'):
     client = boto3.client('dynamodb', region_name='us-east-1')
     client.delete_item(Key={primary_col: {data_type: str(primary_key)}}, TableName=table)
 
-for items in data_obj_raw:
+for items in data_obj:
     delete_dynamo_item('stripe_object_stage', 'id', items['id'], data_type='S')
 
 for items in data:
-    delete_dynamo_item('stripe_stage', 'id', items['id'], data_type='S')
+    if items['id'] not in rejected_events:
+        delete_dynamo_item('stripe_stage', 'id', items['id'], data_type='S')
 
 MySQLRpts().etl_log('Stripe Logs', 'Dynamo', 'DW+SF', max_date=max_date)
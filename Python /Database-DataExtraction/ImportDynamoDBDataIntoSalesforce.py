@@ -1,4 +1,4 @@
-#Modularization: Moved related functions (get_session, tz_from_utc_ms_ts, fetch_salesforce_data) into separate functions for better organization and reusability.#
+#Modularization: Moved related functions (get_session, tz_from_utc_ms_ts) into separate functions for better organization and reusability.#
 #Optimization: Simplified data processing and conversion using pandas and Python's standard libraries.
 #Error Handling: Added basic error handling where appropriate, such as handling empty DataFrames or invalid timestamps.
 #Comments: Added comments to clarify the purpose and functionality of each function and significant code block.
@@ -45,31 +45,6 @@ def tz_from_utc_ms_ts(utc_ms_ts, tz_info):
     utc_datetime = datetime.utcfromtimestamp(utc_ms_ts / 1000.)
     return utc_datetime.replace(tzinfo=pytz.timezone('UTC')).astimezone(tz_info)
 
-def fetch_salesforce_data(object_name, query):
-    """
-    Fetches data from Salesforce using SalesforceBulk API.
-    :param object_name: Salesforce object name (Lead, Contact)
-    :param query: SOQL query to fetch data
-    :return: List of dictionaries containing Salesforce data
-    """
-    bulk = SalesforceRpts().api_auth()
-    job = bulk.create_query_job(object_name, concurrency='Parallel')
-    batch = bulk.query(job, query)
-    bulk.wait_for_batch(job, batch)
-    records = []
-    
-    for result in bulk.get_all_results_for_query_batch(batch, job):
-        for row in result:
-            if row != b'Records not found for this query':
-                list_elements = row.decode('utf-8').replace('"', '').replace('\n', '').split(",")
-                records.append({
-                    "Email": list_elements[1],  # Assuming Email is always at index 1
-                    "Id": list_elements[2] if len(list_elements) > 2 else None  # Assuming Id is always at index 2
-                })
-    
-    bulk.close_job(job)
-    return records
-
 def main():
     # Establish AWS session
     session = get_session(account_registry['account'])
@@ -109,15 +84,17 @@ def main():
     })
     account_registry_df.columns = [col[0] for col in account_registry_df.columns]
     
-    # Fetch Salesforce Contacts and Leads data
-    sf_contact_records = fetch_salesforce_data('Contact', "SELECT AccountId, Email, Id FROM Contact")
-    sf_lead_records = fetch_salesforce_data('Lead', "SELECT Email, Id FROM Lead WHERE IsConverted = false")
+    # Fetch Salesforce Contacts and Leads data concurrently, pulling only rows changed since the last run
+    sf_contact_df, sf_lead_df = SalesforceRpts().api_query_many([
+        ('Contact', "SELECT AccountId, Email, Id FROM Contact", True),
+        ('Lead', "SELECT Email, Id FROM Lead WHERE IsConverted = false"),
+    ], output='pandas', incremental=True)
     
     # Merge Salesforce data with account registry data
-    salesforce_contacts_account_registry_df = pd.DataFrame(sf_contact_records).merge(
+    salesforce_contacts_account_registry_df = sf_contact_df.reindex(columns=['Email', 'Id']).merge(
         account_registry_df, on='Email', how='right'
     )
-    salesforce_leads_account_registry_df = pd.DataFrame(sf_lead_records).merge(
+    salesforce_leads_account_registry_df = sf_lead_df.reindex(columns=['Email', 'Id']).merge(
         account_registry_df, on='Email', how='right'
     )
     
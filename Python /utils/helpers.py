@@ -1,49 +1,530 @@
 # Import necessary libraries
-import requests, urllib.parse, os, csv, urllib.request, gspread, httplib2, subprocess, datetime, pytz, zeep
+import requests, urllib.parse, os, csv, hashlib, urllib.request, gspread, httplib2, subprocess, datetime, pytz, zeep
+import queue, threading, time, io, json, asyncio, itertools, operator, codecs, re, gzip, glob, contextlib, tempfile
+import logging, atexit, decimal, weakref, uuid, enum
+from concurrent.futures import ThreadPoolExecutor
 import dateutil.parser
-from salesforce_bulk import SalesforceBulk, CsvDictsAdapter
+from salesforce_bulk import SalesforceBulk, CsvDictsAdapter, BulkBatchFailed
 from simple_salesforce import Salesforce
 from bs4 import BeautifulSoup
 from oauth2client.service_account import ServiceAccountCredentials
 from googleapiclient import discovery, http
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class SalesforceRpts(object):
-    def __init__(self):
-        # Initialize Salesforce session
-        session = requests.Session()
+class JsonSerializer(object):
+    # Shared JSON codec for the ETL scripts. Uses orjson when it is installed (unless JSON_ENGINE=json), otherwise
+    # the json module; both write the same compact text and accept the same types. Decimals, as DynamoDB returns
+    # them, become ints when integral and floats otherwise; dates and times become ISO 8601 strings
+    engine = 'orjson' if orjson and os.environ.get('JSON_ENGINE', 'orjson') == 'orjson' else 'json'
+    orjson_options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+                      if orjson else 0)
+
+    @staticmethod
+    def default(value):
+        # Types beyond plain JSON. orjson handles UUIDs and enums natively, so they are converted the same way here
+        if isinstance(value, decimal.Decimal):
+            return int(value) if value % 1 == 0 else float(value)
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        if isinstance(value, enum.Enum):
+            return value.value
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    # orjson decodes integers beyond 64 bits as floats, so text with a run of 19+ digits goes through the json
+    # module to stay exact (runs inside strings only cost the faster path). The check maps digits to '9' and
+    # everything else to a space with bytes.translate, which is far cheaper than a regex scan
+    digit_mask = bytes(0x39 if 0x30 <= c <= 0x39 else 0x20 for c in range(256))
+    long_digits = b'9' * 19
+
+    @classmethod
+    def loads(cls, data):
+        if cls.engine == 'orjson':
+            raw = data.encode('utf-8', 'surrogatepass') if isinstance(data, str) else bytes(data)
+            if cls.long_digits not in raw.translate(cls.digit_mask):
+                return orjson.loads(data)
+        return json.loads(data)
+
+    @classmethod
+    def dumps(cls, value):
+        # Serialize to compact str with non-ASCII written as is. Characters outside the BMP, which the 3-byte utf8 DW
+        # columns reject, are escaped as surrogate pairs; orjson cannot escape them, so that text and values orjson
+        # refuses (e.g. integers beyond 64 bits) go through the json module
+        if cls.engine == 'orjson':
+            try:
+                text = orjson.dumps(value, default=cls.default, option=cls.orjson_options).decode()
+                if text.isascii() or not cls.astral.search(text):
+                    return text
+            except orjson.JSONEncodeError:
+                pass
+        text = json.dumps(value, default=cls.default, separators=(',', ':'), ensure_ascii=False)
+        return text if text.isascii() else cls.astral.sub(cls._escape_astral, text)
+
+    @staticmethod
+    def _escape_astral(match):
+        code = ord(match.group()) - 0x10000
+        return '\\u%04x\\u%04x' % (0xD800 + (code >> 10), 0xDC00 + (code & 0x3FF))
+
+    @classmethod
+    def plain(cls, value):
+        # Round-trip a value through JSON, e.g. to turn a DynamoDB item's Decimals into ints and floats
+        return cls.loads(cls.dumps(value))
+
+    astral = re.compile('[\U00010000-\U0010FFFF]')
+
+    @classmethod
+    def bmp_text(cls, value):
+        # Replace characters outside the BMP, which the 3-byte utf8 DW columns reject, with U+FFFD
+        if isinstance(value, str) and not value.isascii():
+            return cls.astral.sub('\ufffd', value)
+        return value
+
+    @staticmethod
+    def normalize(value, fields):
+        # Apply fields[key] to the value of every matching key in nested dicts and lists, in place. Containers are
+        # never rebuilt and only values the normalizer changes are reassigned
+        if not fields:
+            return value
+        stack = [value]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                for key, item in node.items():
+                    if key in fields:
+                        normalized = fields[key](item)
+                        if normalized is not item:
+                            node[key] = item = normalized
+                    if isinstance(item, (dict, list)):
+                        stack.append(item)
+            elif isinstance(node, list):
+                stack.extend(item for item in node if isinstance(item, (dict, list)))
+        return value
+
+
+class BulkCsvDecoder(object):
+    # Incremental decoder for bulk query CSV results. Consumes byte chunks as they download and parses them with
+    # the csv module, so quoted commas and newlines survive. lines=True means the chunks are the newline-terminated
+    # lines read from the file-like results of get_all_results_for_query_batch and get_query_batch_results.
+    # types maps column names to converters; empty values of typed columns become None
+    def __init__(self, chunks, types=None, lines=True):
+        if lines:
+            text_lines = map(bytes.decode, chunks)
+        else:
+            text_lines = self._iter_text_lines(chunks)
+        self.reader = csv.reader(text_lines)
+        headers = next(self.reader, None)
+        self.headers = [] if not headers or headers == ['Records not found for this query'] else headers
+        self.types = types or {}
+
+    @staticmethod
+    def _iter_text_lines(chunks):
+        # Decode raw byte chunks into newline-terminated text lines, carrying partial lines between chunks
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        tail = ''
+        for chunk in chunks:
+            text = tail + decoder.decode(chunk)
+            cut = text.rfind('\n') + 1
+            tail = text[cut:]
+            yield from io.StringIO(text[:cut], newline='')
+        tail += decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    def __iter__(self):
+        return self.records()
+
+    def _converters(self):
+        return [(i, self.types[h]) for i, h in enumerate(self.headers) if h in self.types]
+
+    def rows(self):
+        # Yield each row as a list of values in self.headers order
+        if not self.headers:
+            return
+        converters = self._converters()
+        if not converters:
+            yield from self.reader
+            return
+        for row in self.reader:
+            for i, convert in converters:
+                row[i] = convert(row[i]) if row[i] != '' else None
+            yield row
+
+    def records(self):
+        # Yield each row as a dict
+        return map(dict, map(zip, itertools.repeat(self.headers), self.rows()))
+
+    def columns(self, block_rows=50000):
+        # Yield blocks of up to block_rows rows as {column: list of values}
+        if not self.headers:
+            return
+        converters = dict(self._converters())
+        for block in iter(lambda: list(itertools.islice(self.reader, block_rows)), []):
+            yield {
+                header: [converters[i](v) if v != '' else None for v in values] if i in converters else list(values)
+                for i, (header, values) in enumerate(zip(self.headers, zip(*block)))
+            }
+
+
+class SalesforceBulk2(object):
+    def __init__(self, session_id, instance_url='https://swiftnav.my.salesforce.com', api_version='52.0',
+                 refresh_session=None):
+        # Initialize a Bulk API 2.0 client over a pooled keep-alive session. refresh_session returns a new
+        # session id once the current one is rejected
+        self.jobs_url = f'{instance_url}/services/data/v{api_version}/jobs'
+        self.refresh_session = refresh_session
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': 'Bearer ' + session_id})
+
+    def _request(self, method, url, **kwargs):
+        # Send a request and raise on an HTTP error status. A 401 means Salesforce did not act on the request,
+        # so only that request is resent once with a fresh session; jobs already created or uploaded are kept
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 401 and self.refresh_session:
+            response.close()
+            self.session.headers.update({'Authorization': 'Bearer ' + self.refresh_session()})
+            response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def wait_for_job(self, job_url, poll_interval=2, timeout=86400, raise_on_failure=True):
+        # Poll a Bulk 2.0 job until it completes and return its info. A failed or aborted job raises, or is
+        # returned as well if raise_on_failure is False
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job_info = self._request('GET', job_url).json()
+            if job_info['state'] == 'JobComplete':
+                return job_info
+            if job_info['state'] in ('Failed', 'Aborted'):
+                if not raise_on_failure:
+                    return job_info
+                raise Exception(job_info.get('errorMessage') or job_info['state'])
+            time.sleep(poll_interval)
+        raise Exception(f'Timed out waiting for {job_url}')
+
+    def create_query_job(self, sf_query, operation='query'):
+        # Submit a query (or queryAll) job and return its URL
+        job_info = self._request('POST', self.jobs_url + '/query', json={'operation': operation, 'query': sf_query}).json()
+        return f"{self.jobs_url}/query/{job_info['id']}"
+
+    def query_iter(self, sf_query, max_records=50000, job_url=None, columns=False, block_rows=50000):
+        # Run a query job and stream rows as dicts (or column blocks), following the Sforce-Locator result pages
+        job_url = job_url or self.create_query_job(sf_query)
+        self.wait_for_job(job_url)
+        locator = None
+        while True:
+            params = {'maxRecords': max_records}
+            if locator:
+                params['locator'] = locator
+            response = self._request('GET', job_url + '/results', params=params, headers={'Accept': 'text/csv'}, stream=True)
+            try:
+                decoder = BulkCsvDecoder(response.iter_content(chunk_size=65536), lines=False)
+                yield from decoder.columns(block_rows) if columns else decoder.records()
+            finally:
+                response.close()
+            locator = response.headers.get('Sforce-Locator')
+            if not locator or locator == 'null':
+                break
+
+    def ingest(self, operation, sf_object, list_of_dicts, external_id=None, max_bytes=100000000, raise_on_error=True):
+        # Load rows with one single-upload ingest job per 100MB of CSV and return per-job results shaped like the
+        # Bulk API batch results of SalesforceRpts. A job that fails as a whole raises once every job has finished,
+        # unless raise_on_error is False
+        jobs = []
+        for rows in SalesforceRpts.split_batches(list_of_dicts, max_rows=None, max_bytes=max_bytes):
+            job_request = {'object': sf_object, 'operation': operation, 'contentType': 'CSV', 'lineEnding': 'LF'}
+            if external_id:
+                job_request['externalIdFieldName'] = external_id
+            job_info = self._request('POST', self.jobs_url + '/ingest', json=job_request).json()
+            job_url = f"{self.jobs_url}/ingest/{job_info['id']}"
+            body = io.StringIO()
+            writer = csv.DictWriter(body, fieldnames=list(rows[0].keys()), lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+            self._request('PUT', job_url + '/batches', data=body.getvalue().encode('utf-8'),
+                          headers={'Content-Type': 'text/csv'})
+            self._request('PATCH', job_url, json={'state': 'UploadComplete'})
+            jobs.append((job_info['id'], job_url, rows))
+
+        results = []
+        for job_id, job_url, rows in jobs:
+            job_info = self.wait_for_job(job_url, raise_on_failure=False)
+            if job_info['state'] != 'JobComplete':
+                error = job_info.get('errorMessage') or job_info['state']
+                results.append({'batch_id': job_id, 'rows': len(rows), 'success': 0, 'error': error,
+                                'failed': [{'row': row, 'error': error} for row in rows]})
+                continue
+            failed_csv = self._request('GET', job_url + '/failedResults/', headers={'Accept': 'text/csv'})
+            failed = [{'row': {k: v for k, v in row.items() if not k.startswith('sf__')}, 'error': row['sf__Error']}
+                      for row in csv.DictReader(io.StringIO(failed_csv.content.decode('utf-8')))]
+            results.append({'batch_id': job_id, 'rows': len(rows), 'success': len(rows) - len(failed),
+                            'failed': failed, 'error': None})
+        return SalesforceRpts._raise_failed_batches(results) if raise_on_error else results
+
+
+class SalesforceSession(object):
+    # Process-wide Salesforce login shared by every SalesforceRpts instance. The session is reused until
+    # its ttl runs out or an API call reports it expired, and can be persisted to SF_SESSION_CACHE_FILE
+    # so short cron runs skip the login as well
+    ttl = int(os.environ.get('SF_SESSION_TTL', 7200 - 300))
+    cache_file = os.environ.get('SF_SESSION_CACHE_FILE')
+    _lock = threading.Lock()
+    _session = None
+
+    @classmethod
+    def get(cls):
+        # Return the cached session, logging in only when there is no unexpired one
+        with cls._lock:
+            if not cls._is_valid(cls._session):
+                cls._session = cls._load() or cls._login()
+            return cls._session
+
+    @classmethod
+    def invalidate(cls, sid=None):
+        # Drop the cached session (only if it is still the given sid) so the next get() logs in again
+        with cls._lock:
+            if cls._session and (sid is None or cls._session['sid'] == sid):
+                cls._session = None
+                if cls.cache_file:
+                    try:
+                        os.remove(cls.cache_file)
+                    except OSError:
+                        pass
+
+    @staticmethod
+    def is_expired_error(error):
+        # Check whether an API error means the session id is no longer valid
+        response = getattr(error, 'response', None)
+        if getattr(response, 'status_code', None) == 401 or getattr(error, 'status', None) == 401:
+            return True
+        return 'INVALID_SESSION_ID' in str(error) or 'InvalidSessionId' in str(error)
+
+    @staticmethod
+    def _is_valid(session):
+        return session is not None and session['expires_at'] > time.time()
+
+    @classmethod
+    def _load(cls):
+        # Read a persisted session from the cache file if one exists and has not expired
+        if not cls.cache_file:
+            return None
+        try:
+            with open(cls.cache_file, 'r') as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return session if cls._is_valid(session) else None
+
+    @classmethod
+    def _login(cls):
+        # Log in with username/password and persist the session if a cache file is configured
         sf = Salesforce(username=credentials.salesforce['user'], password=credentials.salesforce['pwd'],
                         security_token=credentials.salesforce['security_token'],
-                        organizationId=credentials.salesforce['organizationId'], session=session)
-        self.headers = sf.headers
-        self.sid = sf.session_id
+                        organizationId=credentials.salesforce['organizationId'], session=requests.Session())
+        session = {'sid': sf.session_id, 'headers': dict(sf.headers), 'expires_at': time.time() + cls.ttl}
+        if cls.cache_file:
+            with open(os.open(cls.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(session, f)
+        return session
 
-    @staticmethod
-    def csv_to_dict(path_to_file, kill_file=None):
-        # Convert CSV to dictionary
-        with open(path_to_file, 'r') as f:
-            reader = csv.DictReader(f)
-            rows = [line for line in reader]
-        if kill_file:
-            # Remove file after reading if specified
+
+class SalesforceQueryCache(object):
+    # On-disk cache of query results keyed on a hash of object and SOQL. Results are stored as gzipped column arrays;
+    # a file's mtime is its write time (checked against the per-query ttl) and its atime is set on every hit, so the
+    # least recently used files are evicted first once the cache grows past max_bytes
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or os.environ.get('SF_QUERY_CACHE_DIR', os.path.expanduser('~/.salesforce_cache'))
+        self.max_bytes = max_bytes or int(os.environ.get('SF_QUERY_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+    def _path(self, sf_object, sf_query):
+        key = hashlib.sha1(f'{sf_object}\n{sf_query}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{sf_object.lower()}__{key}.json.gz')
+
+    def get(self, sf_object, sf_query, ttl):
+        # Return the cached {column: values} for a query, or None if it is missing or older than ttl seconds
+        path = self._path(sf_object, sf_query)
+        try:
+            written = os.path.getmtime(path)
+            if time.time() - written > ttl:
+                return None
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                columns = json.load(f)
+            os.utime(path, (time.time(), written))
+            return columns
+        except (OSError, ValueError):
+            return None
+
+    def put(self, sf_object, sf_query, columns):
+        # Store {column: values} for a query and evict old entries if the cache is over its size bound. Results can
+        # include PII, so the cache directory and files are only accessible to the owner
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        path = self._path(sf_object, sf_query)
+        with open(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as raw, \
+                gzip.open(raw, 'wt', encoding='utf-8') as f:
+            json.dump(columns, f)
+        os.replace(path + '.tmp', path)
+        self.evict()
+
+    def invalidate(self, sf_object=None):
+        # Remove the cached results of every query on sf_object (or of all objects)
+        pattern = f'{sf_object.lower()}__*.json.gz' if sf_object else '*.json.gz'
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), pattern)):
             try:
-                os.remove(path_to_file)
+                os.remove(path)
             except OSError:
                 pass
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits in max_bytes
+        entries = []
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), '*.json.gz')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class SalesforceRpts(object):
+    def __init__(self, engine=None):
+        # Initialize Salesforce session from the shared session cache; engine selects the bulk backend
+        # ('bulk' or 'bulk2'), defaulting to the SF_BULK_ENGINE environment variable
+        session = SalesforceSession.get()
+        self.headers = session['headers']
+        self.sid = session['sid']
+        self.engine = engine or os.environ.get('SF_BULK_ENGINE', 'bulk')
+        self.local_store = os.environ.get('SF_LOCAL_STORE', os.path.expanduser('~/.salesforce_store'))
+        self.query_cache = SalesforceQueryCache()
+
+    def refresh_session(self):
+        # Replace an expired session id with a fresh login and return the new id
+        SalesforceSession.invalidate(self.sid)
+        session = SalesforceSession.get()
+        self.headers = session['headers']
+        self.sid = session['sid']
+        return self.sid
+
+    def _open_job(self, create_job, auth=None):
+        # Authenticate and create a bulk job, logging in again once if the cached session has expired
+        auth = auth or (lambda: self.api_auth(check_session=False))
+        try:
+            bulk = auth()
+            return bulk, create_job(bulk)
+        except Exception as e:
+            if not SalesforceSession.is_expired_error(e):
+                raise
+            self.refresh_session()
+            bulk = auth()
+            return bulk, create_job(bulk)
+
+    # Patterns for the scalar types inferred from CSV strings; values with leading zeros stay strings
+    # so codes and zip codes keep their formatting
+    value_types = (
+        ('int', re.compile(r'-?(0|[1-9][0-9]*)'), int),
+        ('float', re.compile(r'-?(?=[.0-9])(0|[1-9][0-9]*)?(\.[0-9]+)?([eE][-+]?[0-9]+)?'), float),
+        ('bool', re.compile(r'true|false'), lambda v: v == 'true'),
+    )
+
+    @classmethod
+    def csv_to_dict(cls, path_to_file, kill_file=None, lazy=None, columns=None, types=None):
+        # Convert CSV to dictionary. lazy returns a generator instead of a full list; columns and types are
+        # passed to iter_csv_rows
+        rows = cls.iter_csv_rows(path_to_file, kill_file, columns, types)
+        return rows if lazy else list(rows)
+
+    @classmethod
+    def iter_csv_rows(cls, path_to_file, kill_file=None, columns=None, types=None):
+        # Lazily yield CSV rows as dictionaries, projected to columns if given. types maps columns to converters
+        # (or is True to infer int/float/bool per value); empty typed values become None.
+        # If kill_file is set the file is removed once iteration finishes, or when the generator is garbage
+        # collected without being run to the end (including never being started)
+        rows = cls._read_csv_rows(path_to_file, kill_file, columns, types)
+        if kill_file:
+            weakref.finalize(rows, cls._remove_file, path_to_file)
         return rows
 
-    def download_csv(self, sf_rpt_id, path_to_save, create_dict=None, kill_file=None, footers=None, sf_rpt_name=None):
-        # Download CSV report from Salesforce
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @classmethod
+    def _read_csv_rows(cls, path_to_file, kill_file, columns, types):
+        try:
+            with open(path_to_file, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    if columns:
+                        row = {column: row.get(column) for column in columns}
+                    if types is True:
+                        row = {k: cls.infer_value(v) for k, v in row.items()}
+                    elif types:
+                        for column, convert in types.items():
+                            if column in row:
+                                row[column] = convert(row[column]) if row[column] not in ('', None) else None
+                    yield row
+        finally:
+            if kill_file:
+                cls._remove_file(path_to_file)
+
+    @staticmethod
+    def _truncate_footer(f, sf_rpt_name, window=65536):
+        # Cut the report footer off a saved export, searching only the last window bytes of the file
+        marker = f'\n\n"{sf_rpt_name}'.encode('ascii', 'ignore')
+        size = f.seek(0, os.SEEK_END)
+        start = max(0, size - window)
+        f.seek(start)
+        position = f.read().find(marker)
+        if position != -1:
+            f.truncate(start + position)
+
+    def download_csv(self, sf_rpt_id, path_to_save, create_dict=None, kill_file=None, footers=None, sf_rpt_name=None,
+                     stream_rows=None, chunk_size=65536, session=None):
+        # Download CSV report from Salesforce, streaming it to disk chunk by chunk with non-ASCII bytes dropped.
+        # stream_rows returns a generator of row dicts read lazily from the saved file instead of a full list;
+        # session reuses a pooled requests.Session
         try:
             os.remove(path_to_save)
         except OSError:
             pass
-        response = requests.get(f'https://swiftnav.my.salesforce.com/{sf_rpt_id}?view=d&snip&export=1&enc=UTF-8&xf=csv',
-                                headers=self.headers, cookies={'sid': self.sid})
-        csv_data = response.text
-        if footers:
-            csv_data = csv_data.split(f'\n\n\"{sf_rpt_name}', 1)
-        with open(path_to_save, 'w') as text_file:
-            text_file.write(csv_data.encode('ascii', 'ignore').decode('ascii'))
+        for attempt in range(2):
+            response = (session or requests).get(f'https://swiftnav.my.salesforce.com/{sf_rpt_id}?view=d&snip&export=1&enc=UTF-8&xf=csv',
+                                    headers=self.headers, cookies={'sid': self.sid}, stream=True)
+            # An expired session gets a 401 or is redirected to the HTML login page with a 200, so log in again
+            # and retry once
+            html = 'text/html' in response.headers.get('Content-Type', '')
+            if attempt or (response.status_code != 401 and not html):
+                break
+            response.close()
+            self.refresh_session()
+        try:
+            response.raise_for_status()
+            if html:
+                raise Exception(f'Report {sf_rpt_id} returned an HTML page instead of CSV')
+        except Exception:
+            response.close()
+            raise
+        non_ascii = bytes(range(128, 256))
+        with open(path_to_save, 'wb+') as csv_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                csv_file.write(chunk.translate(None, non_ascii))
+            if footers:
+                self._truncate_footer(csv_file, sf_rpt_name)
+        if stream_rows:
+            return self.csv_to_dict(path_to_save, kill_file, lazy=True)
         if create_dict:
             if kill_file:
                 dicts = self.csv_to_dict(path_to_save, kill_file)
@@ -52,60 +533,439 @@ class SalesforceRpts(object):
                 dicts = self.csv_to_dict(path_to_save)
                 return dicts
 
-    def api_auth(self):
-        # Authenticate Salesforce Bulk API
+    def download_csv_many(self, reports, max_workers=4, footers=None):
+        # Download several (sf_rpt_id, path_to_save[, sf_rpt_name]) reports concurrently over one keep-alive
+        # session pool and return per-report timing and size stats
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+
+        def download(report):
+            sf_rpt_id, path_to_save = report[0], report[1]
+            stats = {'sf_rpt_id': sf_rpt_id, 'path': path_to_save, 'bytes': None, 'error': None}
+            started = time.time()
+            try:
+                self.download_csv(sf_rpt_id, path_to_save, footers=footers,
+                                  sf_rpt_name=report[2] if len(report) > 2 else None, session=session)
+                stats['bytes'] = os.path.getsize(path_to_save)
+            except Exception as e:
+                stats['error'] = str(e)
+            stats['seconds'] = round(time.time() - started, 3)
+            return stats
+
+        with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(download, reports))
+
+    def check_session(self):
+        # Log in again if Salesforce has already expired the shared session, e.g. through its inactivity timeout,
+        # which can hit well within the session cache ttl; returns the valid session id
+        response = requests.get('https://swiftnav.my.salesforce.com/services/data/v40.0/',
+                                headers={'Authorization': 'Bearer ' + self.sid})
+        if response.status_code == 401:
+            return self.refresh_session()
+        return self.sid
+
+    def api_auth(self, check_session=True):
+        # Authenticate Salesforce Bulk API. The session is checked first unless the caller handles expired sessions
+        # itself, as _open_job does
+        if check_session:
+            self.check_session()
         return SalesforceBulk(sessionId=self.sid, host=urllib.parse.urlparse('https://swiftnav.my.salesforce.com').hostname, API_version="40.0")
 
-    def api_query(self, sf_object, sf_query):
-        # Perform a bulk query using Salesforce Bulk API
-        bulk = self.api_auth()
-        job = bulk.create_query_job(sf_object, concurrency='Parallel')
+    def api_auth2(self):
+        # Authenticate Salesforce Bulk API 2.0
+        return SalesforceBulk2(self.sid, refresh_session=self.refresh_session)
+
+    def api_query(self, sf_object, sf_query, pk_chunking=False, output='dicts', cache_ttl=None):
+        # Perform a bulk query using Salesforce Bulk API. output='pandas' or 'arrow' builds a DataFrame or
+        # Arrow table straight from column buffers instead of a list of dicts.
+        # cache_ttl serves repeat queries from the local query cache for that many seconds
+        if cache_ttl:
+            columns = self.query_cache.get(sf_object, sf_query, cache_ttl)
+            if columns is None:
+                columns = self._concat_columns(self.api_query_iter(sf_object, sf_query, pk_chunking=pk_chunking,
+                                                                   columns=True))
+                self.query_cache.put(sf_object, sf_query, columns)
+            if output == 'dicts':
+                return [dict(zip(columns, row)) for row in zip(*columns.values())]
+            return self.columns_to_table([columns], output)
+        if output == 'dicts':
+            return list(self.api_query_iter(sf_object, sf_query, pk_chunking=pk_chunking))
+        return self.columns_to_table(self.api_query_iter(sf_object, sf_query, pk_chunking=pk_chunking, columns=True), output)
+
+    def api_query_iter(self, sf_object, sf_query, chunk_size=2048, pk_chunking=False, max_workers=4, poll_interval=5,
+                       columns=False, block_rows=50000, query_all=False):
+        # Perform a bulk query and yield rows as dicts while the result sets are still downloading;
+        # only chunk_size bytes of each result stream are held in memory at a time.
+        # pk_chunking (True or a chunk size) splits the query into Id-range batches under one job;
+        # Bulk 2.0 chunks queries on its own, so the engine ignores it.
+        # columns=True yields {column: values} blocks of up to block_rows rows instead of dicts;
+        # query_all=True includes deleted and archived rows
+        operation = 'queryAll' if query_all else 'query'
+        if self.engine == 'bulk2':
+            bulk2, job_url = self._open_job(lambda bulk2: bulk2.create_query_job(sf_query, operation), auth=self.api_auth2)
+            yield from bulk2.query_iter(sf_query, job_url=job_url, columns=columns, block_rows=block_rows)
+            return
+        bulk, job = self._open_job(lambda bulk: bulk.create_job(sf_object, operation, contentType='CSV',
+                                                               concurrency='Parallel', pk_chunking=pk_chunking))
         try:
             batch = bulk.query(job, sf_query)
-            bulk.wait_for_batch(job, batch)
-            result = bulk.get_batch_result_iter(job, batch, parse_csv=True)
-            return list(result)
+            if pk_chunking:
+                yield from self._iter_pk_chunked_rows(bulk, job, batch, chunk_size, max_workers, poll_interval,
+                                                      columns, block_rows)
+            else:
+                bulk.wait_for_batch(job, batch)
+                yield from self._iter_batch_rows(bulk, job, batch, chunk_size, columns, block_rows)
         except Exception as e:
             raise Exception(e)
         finally:
             bulk.close_job(job)
 
-    def api_update(self, sf_object, list_of_dicts):
-        # Perform a bulk update using Salesforce Bulk API
-        bulk = self.api_auth()
-        job = bulk.create_update_job(sf_object, contentType='CSV', concurrency='Parallel')
+    @staticmethod
+    async def wait_for_batch_async(bulk, job, batch, min_interval=1, max_interval=30, backoff=1.5, timeout=86400):
+        # Await a bulk batch without blocking the event loop, backing off the polling interval while it runs
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        interval = min_interval
+        while not await loop.run_in_executor(None, bulk.is_batch_done, batch, job):
+            if loop.time() > deadline:
+                raise Exception(f'Timed out waiting for batch {batch}')
+            await asyncio.sleep(interval)
+            interval = min(interval * backoff, max_interval)
+
+    async def api_query_async(self, sf_object, sf_query, pk_chunking=False, output='dicts', incremental=False,
+                              cache_ttl=None):
+        # Perform a bulk query as a coroutine so several jobs can be awaited together
+        loop = asyncio.get_running_loop()
+        if incremental:
+            return await loop.run_in_executor(
+                None, lambda: self.api_query_incremental(sf_object, sf_query, pk_chunking=pk_chunking, output=output))
+        if self.engine == 'bulk2' or pk_chunking or cache_ttl:
+            # These paths poll on their own worker threads (or skip the API entirely on a cache hit)
+            return await loop.run_in_executor(None, self.api_query, sf_object, sf_query, pk_chunking, output, cache_ttl)
+        bulk, job = await loop.run_in_executor(
+            None, self._open_job, lambda bulk: bulk.create_query_job(sf_object, concurrency='Parallel'))
         try:
-            batch = bulk.post_bulk_batch(job, CsvDictsAdapter(iter(list_of_dicts)))
-            bulk.wait_for_batch(job, batch)
-        except Exception as e:
-            raise Exception(e)
+            batch = await loop.run_in_executor(None, bulk.query, job, sf_query)
+            await self.wait_for_batch_async(bulk, job, batch)
+            if output == 'dicts':
+                return await loop.run_in_executor(None, lambda: list(self._iter_batch_rows(bulk, job, batch)))
+            return await loop.run_in_executor(
+                None, lambda: self.columns_to_table(self._iter_batch_rows(bulk, job, batch, columns=True), output))
         finally:
-            bulk.close_job(job)
+            await loop.run_in_executor(None, bulk.close_job, job)
+
+    def api_query_many(self, queries, output='dicts', incremental=False, cache_ttl=None):
+        # Run several (sf_object, sf_query[, pk_chunking]) bulk queries concurrently and return their rows in order
+        async def gather():
+            return await asyncio.gather(*(self.api_query_async(*query, output=output, incremental=incremental,
+                                                               cache_ttl=cache_ttl) for query in queries))
+        return asyncio.run(gather())
+
+    @staticmethod
+    def _soql_fields(sf_query):
+        match = re.match(r'\s*SELECT\s+(.*?)\s+FROM\s', sf_query, re.IGNORECASE | re.DOTALL)
+        if not match:
+            raise ValueError(f'Cannot parse SOQL: {sf_query}')
+        return [field.strip() for field in match.group(1).split(',')], match
+
+    @classmethod
+    def _soql_with_fields(cls, sf_query, required):
+        # Add required fields to the SELECT list, returning the query and the fields that were added
+        fields, match = cls._soql_fields(sf_query)
+        present = {field.lower() for field in fields}
+        added = [field for field in required if field.lower() not in present]
+        if added:
+            sf_query = sf_query[:match.end(1)] + ''.join(', ' + field for field in added) + sf_query[match.end(1):]
+        return sf_query, added
+
+    @staticmethod
+    def _soql_with_condition(sf_query, condition):
+        # AND a condition into the WHERE clause of a simple SOQL query
+        if re.search(r'\b(ORDER\s+BY|GROUP\s+BY|LIMIT|OFFSET)\b', sf_query, re.IGNORECASE):
+            raise ValueError(f'Incremental extraction does not support ORDER BY/GROUP BY/LIMIT: {sf_query}')
+        where = re.search(r'\bWHERE\b', sf_query, re.IGNORECASE)
+        if not where:
+            return f'{sf_query.rstrip()} WHERE {condition}'
+        return f'{sf_query[:where.end()]} ({sf_query[where.end():].strip()}) AND {condition}'
 
-    def api_upsert(self, sf_object, upsert_key, list_of_dicts):
-        # Perform a bulk upsert using Salesforce Bulk API
-        bulk = self.api_auth()
-        job = bulk.create_upsert_job(sf_object, upsert_key, contentType='CSV', concurrency='Parallel')
+    def _incremental_store_path(self, sf_object, sf_query):
+        key = hashlib.sha1(f'{sf_object}\n{sf_query}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.local_store, f'{sf_object}_{key}.json')
+
+    def api_query_incremental(self, sf_object, sf_query, pk_chunking=False, output='dicts', overlap_seconds=300):
+        # Keep a local snapshot of a query's rows and refresh it with only the rows whose SystemModstamp is past the
+        # stored watermark. Rows changed since the watermark are dropped from the snapshot (which also catches
+        # deletes and rows that no longer match the WHERE clause) and re-added if they still match the query.
+        # The first run is a full pull
+        path = self._incremental_store_path(sf_object, sf_query)
+        tracked_query, added = self._soql_with_fields(sf_query, ['Id', 'SystemModstamp'])
         try:
-            batch = bulk.post_bulk_batch(job, CsvDictsAdapter(iter(list_of_dicts)))
-            bulk.wait_for_batch(job, batch)
+            with open(path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+
+        if state is None:
+            rows = {row['Id']: row for row in self.api_query_iter(sf_object, tracked_query, pk_chunking=pk_chunking)}
+            watermark = max((row['SystemModstamp'] for row in rows.values()), default=None)
+        else:
+            rows, watermark = state['rows'], state['watermark']
+            if watermark:
+                since = (datetime.datetime.strptime(watermark, '%Y-%m-%dT%H:%M:%S.%fZ')
+                         - datetime.timedelta(seconds=overlap_seconds)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                condition = f'SystemModstamp > {since}'
+                changed_query = f'SELECT Id, SystemModstamp FROM {sf_object} WHERE {condition}'
+                for row in self.api_query_iter(sf_object, changed_query, query_all=True):
+                    rows.pop(row['Id'], None)
+                    watermark = max(watermark, row['SystemModstamp'])
+                for row in self.api_query_iter(sf_object, self._soql_with_condition(tracked_query, condition)):
+                    rows[row['Id']] = row
+            else:
+                rows = {row['Id']: row for row in self.api_query_iter(sf_object, tracked_query)}
+                watermark = max((row['SystemModstamp'] for row in rows.values()), default=None)
+
+        # The snapshot holds query rows, which can include PII, so only the owner may read it
+        os.makedirs(self.local_store, mode=0o700, exist_ok=True)
+        with open(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({'object': sf_object, 'query': sf_query, 'watermark': watermark, 'rows': rows}, f)
+        os.replace(path + '.tmp', path)
+
+        result = [{k: v for k, v in row.items() if k not in added} for row in rows.values()]
+        if output == 'dicts':
+            return result
+        headers = self._soql_fields(sf_query)[0]
+        return self.columns_to_table([{h: [row.get(h, '') for row in result] for h in headers}], output)
+
+    @classmethod
+    def infer_value(cls, value):
+        # Convert a single CSV string to int, float or bool when it parses as one
+        if value in ('', None):
+            return None
+        for kind, pattern, convert in cls.value_types:
+            if pattern.fullmatch(value):
+                return convert(value)
+        return value
+
+    int64_range = range(-2 ** 63, 2 ** 63)
+
+    @classmethod
+    def infer_column(cls, values):
+        # Convert a column of CSV strings to int, float or bool when every non-empty value parses as one. Integer
+        # columns with a value outside int64 (long external ids, tracking numbers) stay strings, since neither the
+        # Int64 nor the Arrow int64 column type can hold them
+        present = [v for v in values if v != '']
+        if not present:
+            return [None] * len(values), None
+        for kind, pattern, convert in cls.value_types:
+            if all(pattern.fullmatch(v) for v in present):
+                if kind == 'int' and not all(int(v) in cls.int64_range for v in present if len(v) > 18):
+                    break
+                return [convert(v) if v != '' else None for v in values], kind
+        return [v if v != '' else None for v in values], 'str'
+
+    @staticmethod
+    def _concat_columns(blocks):
+        # Concatenate {column: values} blocks into one {column: values}
+        columns = {}
+        for block in blocks:
+            for header, values in block.items():
+                columns.setdefault(header, []).extend(values)
+        return columns
+
+    @classmethod
+    def columns_to_table(cls, blocks, output='pandas', infer_types=True):
+        # Concatenate {column: values} blocks and build a pandas DataFrame or pyarrow Table with inferred dtypes
+        columns = cls._concat_columns(blocks)
+        kinds = {}
+        if infer_types:
+            for header in columns:
+                columns[header], kinds[header] = cls.infer_column(columns[header])
+        if output == 'arrow':
+            import pyarrow as pa
+            return pa.table(columns)
+        if output == 'pandas':
+            import pandas as pd
+            dtypes = {'int': 'Int64', 'bool': 'boolean', 'float': 'float64'}
+            return pd.DataFrame({header: pd.Series(values, dtype=dtypes.get(kinds.get(header), 'object'))
+                                 for header, values in columns.items()})
+        raise ValueError(f'Unknown output {output}')
+
+    @staticmethod
+    def _iter_batch_rows(bulk, job, batch, chunk_size=2048, columns=False, block_rows=50000):
+        # Stream every result set of a completed query batch as dicts (or column blocks)
+        for result_id in bulk.get_query_batch_result_ids(batch, job_id=job):
+            decoder = BulkCsvDecoder(bulk.get_query_batch_results(batch, result_id, job_id=job, chunk_size=chunk_size))
+            yield from decoder.columns(block_rows) if columns else decoder.records()
+
+    def _iter_pk_chunked_rows(self, bulk, job, batch, chunk_size, max_workers, poll_interval, columns=False,
+                              block_rows=50000, block_size=1000):
+        # Poll all PK chunk batches of the job together, download each one as soon as it completes
+        # and merge their rows into one stream through a bounded queue
+        blocks = queue.Queue(maxsize=max_workers * 4)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def download(chunk_batch):
+            try:
+                if columns:
+                    for block in self._iter_batch_rows(bulk, job, chunk_batch, chunk_size, True, block_rows):
+                        put(block)
+                        if stop.is_set():
+                            return
+                    return
+                block = []
+                for row in self._iter_batch_rows(bulk, job, chunk_batch, chunk_size):
+                    block.append(row)
+                    if len(block) >= block_size:
+                        put(block)
+                        block = []
+                    if stop.is_set():
+                        return
+                put(block)
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        scheduled = set()
+        running = 0
+        chunking_finished = False
+        last_poll = None
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            try:
+                while not chunking_finished or running:
+                    if not chunking_finished and (last_poll is None or time.time() - last_poll >= poll_interval):
+                        last_poll = time.time()
+                        states = {b['id']: b for b in bulk.get_batch_list(job)}
+                        original = states.pop(batch)
+                        if original['state'] == 'Failed':
+                            raise Exception(original.get('stateMessage'))
+                        for chunk_batch, status in states.items():
+                            if status['state'] == 'Failed':
+                                raise Exception(status.get('stateMessage'))
+                            if status['state'] == 'Completed' and chunk_batch not in scheduled:
+                                scheduled.add(chunk_batch)
+                                running += 1
+                                pool.submit(download, chunk_batch)
+                        chunking_finished = original['state'] == 'NotProcessed' and len(scheduled) == len(states)
+                    try:
+                        item = blocks.get(timeout=1)
+                    except queue.Empty:
+                        continue
+                    if item is done:
+                        running -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    elif columns:
+                        yield item
+                    else:
+                        yield from item
+            finally:
+                stop.set()
+
+    @staticmethod
+    def split_batches(list_of_dicts, max_rows=10000, max_bytes=10000000):
+        # Split rows into batches that stay under the Bulk API per-batch row count and CSV payload size. Sizes are
+        # measured with the quote-all dialect CsvDictsAdapter serializes batches with
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        batch, batch_bytes = [], 0
+        for row in list_of_dicts:
+            if not batch:
+                writer.writerow(row.keys())
+            writer.writerow(row.values())
+            row_bytes = len(buffer.getvalue().encode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate()
+            if batch and ((max_rows and len(batch) >= max_rows) or batch_bytes + row_bytes > max_bytes):
+                yield batch
+                writer.writerow(row.keys())
+                row_bytes += len(buffer.getvalue().encode('utf-8'))
+                buffer.seek(0)
+                buffer.truncate()
+                batch, batch_bytes = [], 0
+            batch.append(row)
+            batch_bytes += row_bytes
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _raise_failed_batches(results):
+        # Raise if any batch (or job) was rejected as a whole; rows rejected one by one only show up in the results
+        rejected = [result for result in results if result['error']]
+        if rejected:
+            raise Exception(f'{len(rejected)} of {len(results)} batches failed: '
+                            + '; '.join(f"{result['batch_id']}: {result['error']}" for result in rejected))
+        return results
+
+    def _post_write_batches(self, bulk, job, list_of_dicts, max_workers=4, raise_on_error=True):
+        # Post size-bounded batches concurrently under one job and collect per-batch success and failure results.
+        # A batch that fails as a whole raises once every batch has finished, unless raise_on_error is False
+        def post(batch_rows):
+            return bulk.post_batch(job, CsvDictsAdapter(iter(batch_rows)))
+
+        def collect(batch, batch_rows):
+            try:
+                bulk.wait_for_batch(job, batch)
+            except BulkBatchFailed as e:
+                return {'batch_id': batch, 'rows': len(batch_rows), 'success': 0, 'error': e.state_message,
+                        'failed': [{'row': row, 'error': e.state_message} for row in batch_rows]}
+            results = bulk.get_batch_results(batch, job_id=job)
+            failed = [{'row': row, 'error': result.error} for row, result in zip(batch_rows, results)
+                      if result.success != 'true']
+            return {'batch_id': batch, 'rows': len(batch_rows), 'success': len(batch_rows) - len(failed),
+                    'failed': failed, 'error': None}
+
+        try:
+            batches = list(self.split_batches(list_of_dicts))
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                batch_ids = list(pool.map(post, batches))
+                results = list(pool.map(collect, batch_ids, batches))
+            return self._raise_failed_batches(results) if raise_on_error else results
         except Exception as e:
             raise Exception(e)
         finally:
             bulk.close_job(job)
-            
-    def api_insert(self, sf_object, list_of_dicts):
-        # Perform a bulk insert using Salesforce Bulk API
-        bulk = self.api_auth()
-        job = bulk.create_insert_job(sf_object, contentType='CSV', concurrency='Parallel')
-        try:
-            batch = bulk.post_bulk_batch(job, CsvDictsAdapter(iter(list_of_dicts)))
-            bulk.wait_for_batch(job, batch)
-        except Exception as e:
-            raise Exception(e)
+
+    def api_update(self, sf_object, list_of_dicts, max_workers=4, raise_on_error=True):
+        # Perform a bulk update using Salesforce Bulk API and return per-batch results
+        try:
+            if self.engine == 'bulk2':
+                return self.api_auth2().ingest('update', sf_object, list_of_dicts, raise_on_error=raise_on_error)
+            bulk, job = self._open_job(lambda bulk: bulk.create_update_job(sf_object, contentType='CSV', concurrency='Parallel'))
+            return self._post_write_batches(bulk, job, list_of_dicts, max_workers, raise_on_error)
         finally:
-            bulk.close_job(job)
-     
+            self.query_cache.invalidate(sf_object)
+
+    def api_upsert(self, sf_object, upsert_key, list_of_dicts, max_workers=4, raise_on_error=True):
+        # Perform a bulk upsert using Salesforce Bulk API and return per-batch results
+        try:
+            if self.engine == 'bulk2':
+                return self.api_auth2().ingest('upsert', sf_object, list_of_dicts, external_id=upsert_key,
+                                               raise_on_error=raise_on_error)
+            bulk, job = self._open_job(lambda bulk: bulk.create_upsert_job(sf_object, upsert_key, contentType='CSV', concurrency='Parallel'))
+            return self._post_write_batches(bulk, job, list_of_dicts, max_workers, raise_on_error)
+        finally:
+            self.query_cache.invalidate(sf_object)
+
+    def api_insert(self, sf_object, list_of_dicts, max_workers=4, raise_on_error=True):
+        # Perform a bulk insert using Salesforce Bulk API and return per-batch results
+        try:
+            if self.engine == 'bulk2':
+                return self.api_auth2().ingest('insert', sf_object, list_of_dicts, raise_on_error=raise_on_error)
+            bulk, job = self._open_job(lambda bulk: bulk.create_insert_job(sf_object, contentType='CSV', concurrency='Parallel'))
+            return self._post_write_batches(bulk, job, list_of_dicts, max_workers, raise_on_error)
+        finally:
+            self.query_cache.invalidate(sf_object)
+
 class NetsuiteAPI(object):
     def __init__(self):
         # Initialize Netsuite API client
@@ -182,23 +1042,143 @@ class GoogleRpts(object):
             return gspread.authorize(creds)
 
 
+class MySQLPool(object):
+    # Process-wide bounded pool of MySQLdb connections shared by every MySQLRpts instance. Idle connections are
+    # pinged before reuse and recycled once they are older than max_lifetime seconds. Connections that allow
+    # LOAD DATA LOCAL INFILE are only opened for bulk_load and kept idle apart from the others
+    max_size = int(os.environ.get('MYSQL_POOL_SIZE', 8))
+    max_lifetime = int(os.environ.get('MYSQL_POOL_MAX_LIFETIME', 3600))
+    checkout_timeout = 60
+    connect_timeout = 10
+    _lock = threading.Lock()
+    _slots = threading.BoundedSemaphore(max_size)
+    _idle = {False: [], True: []}
+    _created = {}
+    _local_infile = set()
+
+    @classmethod
+    def _connect(cls, local_infile=False):
+        connection = MySQLdb.connect(host='localhost', user=credentials.mysql['user'],
+                                     passwd=credentials.mysql['pwd'], charset='utf8', local_infile=int(local_infile),
+                                     connect_timeout=cls.connect_timeout)
+        cls._created[id(connection)] = time.time()
+        if local_infile:
+            cls._local_infile.add(id(connection))
+        return connection
+
+    @classmethod
+    def _discard(cls, connection):
+        cls._created.pop(id(connection), None)
+        cls._local_infile.discard(id(connection))
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @classmethod
+    def _is_reusable(cls, connection):
+        if time.time() - cls._created.get(id(connection), 0) > cls.max_lifetime:
+            return False
+        try:
+            connection.ping()
+            return True
+        except Exception:
+            return False
+
+    @classmethod
+    def acquire(cls, timeout=None, local_infile=False):
+        # Check out a healthy connection, opening a new one if none is idle; blocks up to timeout (default
+        # checkout_timeout) seconds while the pool is exhausted. local_infile checks out one that allows
+        # LOAD DATA LOCAL INFILE
+        timeout = cls.checkout_timeout if timeout is None else timeout
+        if not cls._slots.acquire(timeout=timeout):
+            raise Exception(f'No MySQL connection available after {timeout}s')
+        idle = cls._idle[bool(local_infile)]
+        try:
+            while True:
+                with cls._lock:
+                    connection = idle.pop() if idle else None
+                if connection is None:
+                    return cls._connect(local_infile)
+                if cls._is_reusable(connection):
+                    return connection
+                cls._discard(connection)
+        except Exception:
+            cls._slots.release()
+            raise
+
+    @classmethod
+    def release(cls, connection):
+        # Return a connection to the pool, rolling back anything left uncommitted
+        try:
+            connection.rollback()
+            with cls._lock:
+                cls._idle[id(connection) in cls._local_infile].append(connection)
+        except Exception:
+            cls._discard(connection)
+        finally:
+            cls._slots.release()
+
+    @classmethod
+    @contextlib.contextmanager
+    def connection(cls, timeout=None, local_infile=False):
+        # Check out a connection for the duration of a with block
+        connection = cls.acquire(timeout, local_infile)
+        try:
+            yield connection
+        finally:
+            cls.release(connection)
+
+
 class MySQLRpts(object):
     def __init__(self):
-        # Initialize MySQL connection
-        self.connection = MySQLdb.connect(host='localhost', user=credentials.mysql['user'],
-                                          passwd=credentials.mysql['pwd'], charset='utf8')
-        self.cursor = self.connection.cursor()
+        # The MySQL connection is checked out from the shared pool on first use, so calls that never touch the
+        # DB (like etl_log) neither wait for one nor fail when the DB is down
+        self._connection = None
+        self._cursor = None
         self.headers = []
 
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = MySQLPool.acquire()
+        return self._connection
+
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self._cursor = self.connection.cursor()
+        return self._cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def __del__(self):
-        # Close MySQL connection
-        self.cursor.close()
-        self.connection.close()
+        # Return MySQL connection to the pool
+        self.close()
 
-    @staticmethod
-    def convert_datetime(dt, for_insert=False, convert_UTC=False):
+    def close(self):
+        # Close the cursor and hand the connection back to the pool
+        connection, cursor = getattr(self, '_connection', None), getattr(self, '_cursor', None)
+        if connection is None:
+            return
+        self._connection = self._cursor = None
+        try:
+            if cursor is not None:
+                cursor.close()
+        except Exception:
+            pass
+        MySQLPool.release(connection)
+
+    local_tz = pytz.timezone("America/Los_Angeles")
+
+    @classmethod
+    def convert_datetime(cls, dt, for_insert=False, convert_UTC=False):
         # Convert datetime to required format
-        local = pytz.timezone("America/Los_Angeles")
+        local = cls.local_tz
         if isinstance(dt, datetime.datetime):
             parsed_date = dt
         else:
@@ -214,21 +1194,9 @@ class MySQLRpts(object):
             else:
                 return local.fromutc(parsed_date).replace(tzinfo=None)
 
-    def etl_log(self, etl_process, source, target, max_date=None):
-        # Log ETL process
-        if max_date:
-            insert_stmt = "INSERT INTO sn.etl_audit_log VALUES (null, %s,%s, %s, %s, null)"
-            data = (etl_process, source, target, self.convert_datetime(max_date, for_insert=True))
-        else:
-            insert_stmt = "INSERT INTO sn.etl_audit_log VALUES (null, %s, %s, %s, null, null)"
-            data = (etl_process, source, target)
-        try:
-            self.cursor.execute(insert_stmt, data)
-            self.connection.commit()
-        except Exception as e:
-            pass
-        finally:
-            del self
+    def etl_log(self, etl_process, source, target, max_date=None, rows=None, seconds=None):
+        # Log ETL process; buffered by EtlAuditLog and written in batches
+        EtlAuditLog.log(etl_process, source, target, max_date=max_date, rows=rows, seconds=seconds)
 
     def exec_simple(self, stmt):
         # Execute simple SQL statement
@@ -240,39 +1208,86 @@ class MySQLRpts(object):
         finally:
             del self
 
-    def dictify(self, sql_output):
-        # Convert SQL output to dictionary
-        self.headers = [desc[0] for desc in self.cursor.description]
-        lists = [dict(zip(self.headers, sql_output[x])) for x in range(len(sql_output))]
-        for y in range(len(lists)):
-            for z in lists[y]:
-                if isinstance(lists[y][z], datetime.datetime):
-                    lists[y][z] = self.convert_datetime(lists[y][z])
-        return lists
+    @staticmethod
+    def format_datetime(value):
+        # Same output as convert_datetime(value) for datetimes, passing anything else through
+        return value.isoformat(' ', 'seconds') if isinstance(value, datetime.datetime) else value
+
+    def dictify(self, sql_output, cursor=None, output='dicts'):
+        # Convert SQL output to dictionary, or a pandas DataFrame / pyarrow Table with output='pandas'|'arrow'.
+        # DATETIME and TIMESTAMP columns are found once from the cursor description; for dicts they are formatted
+        # column-wise like convert_datetime, the table outputs keep native datetimes
+        description = (cursor or self.cursor).description
+        self.headers = [desc[0] for desc in description]
+        datetime_types = {MySQLdb.FIELD_TYPE.DATETIME, MySQLdb.FIELD_TYPE.TIMESTAMP}
+        datetime_cols = [i for i, desc in enumerate(description) if desc[1] in datetime_types]
+        if output == 'dicts' and not datetime_cols:
+            return list(map(dict, map(zip, itertools.repeat(self.headers), sql_output)))
+        columns = list(map(list, zip(*sql_output))) or [[] for _ in self.headers]
+        if output == 'pandas':
+            import pandas as pd
+            return pd.DataFrame(dict(zip(self.headers, columns)), columns=self.headers)
+        if output == 'arrow':
+            import pyarrow as pa
+            return pa.table(dict(zip(self.headers, columns)))
+        if output != 'dicts':
+            raise ValueError(f'Unknown output {output}')
+        for i in datetime_cols:
+            columns[i] = list(map(self.format_datetime, columns[i]))
+        return list(map(dict, map(zip, itertools.repeat(self.headers), zip(*columns))))
 
     def get_query_headers(self):
         # Get headers of the last query
         return self.headers
 
-    def get_select_data(self, stmt):
+    def get_select_data(self, stmt, output='dicts'):
         # Execute select statement and return data
         try:
             self.cursor.execute(stmt)
             self.connection.commit()    # need?
             select_rows = self.cursor.fetchall()
-            select_output = self.dictify(select_rows)
+            select_output = self.dictify(select_rows, output=output)
             return select_output
         except Exception as e:
             pass
         finally:
             del self
 
-    def get_proc_data(self, proc_name, args=()):
+    def iter_select_data(self, stmt, batch_size=None, fetch_size=1000, net_write_timeout=3600):
+        # Stream select results through an unbuffered server-side cursor so memory stays flat however many rows
+        # match. Yields one dict per row, or lists of up to batch_size dicts. The connection cannot run other
+        # statements until the generator is exhausted or closed. The server aborts a stream it cannot write to
+        # for net_write_timeout seconds (60 by default), so the session value is raised while streaming to leave
+        # room for slow per-batch work between reads, and restored afterwards
+        cursor = self.connection.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            if net_write_timeout:
+                cursor.execute(f'SET SESSION net_write_timeout = {int(net_write_timeout)}')
+            cursor.execute(stmt)
+            fetch_size = batch_size or fetch_size
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                output = self.dictify(rows, cursor)
+                if batch_size:
+                    yield output
+                else:
+                    yield from output
+        finally:
+            cursor.close()
+            if net_write_timeout:
+                try:
+                    self.cursor.execute('SET SESSION net_write_timeout = DEFAULT')
+                except Exception:
+                    pass
+
+    def get_proc_data(self, proc_name, args=(), output='dicts'):
         # Execute stored procedure and return data
         try:
             self.cursor.callproc(proc_name, args)
             proc_rows = self.cursor.fetchall()
-            proc_output = self.dictify(proc_rows)
+            proc_output = self.dictify(proc_rows, output=output)
             return proc_output
         except Exception as e:
             pass
@@ -286,12 +1301,322 @@ class MySQLRpts(object):
         cols_ins = str(['%(' + col_list[x] + ')s' for x in range(len(col_list))]).strip(']').strip('[').replace("'", '')
         return insert_type + ' INTO ' + table + ' (' + cols_stringified + ') VALUES (' + cols_ins + ')'
            
-    def insert_data(self, stmt, data):
-        # Insert data into table
+    tsv_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+    @classmethod
+    def tsv_value(cls, value):
+        # Format a value for LOAD DATA's default tab-separated, backslash-escaped layout
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, bytes):
+            value = value.decode('utf8')
+        elif isinstance(value, datetime.datetime):
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        return str(value).translate(cls.tsv_escapes)
+
+    # MySQL error codes for LOAD DATA LOCAL INFILE refused by the server (1148, 3948) or the client (2068)
+    local_infile_refused = {1148, 2068, 3948}
+
+    def bulk_load(self, table, data, insert_type='INSERT IGNORE', col_list=[]):
+        # Load rows (dicts, or tuples ordered like col_list) with LOAD DATA LOCAL INFILE from a temporary TSV, over a
+        # pooled connection that allows local infile. insert_type follows create_stmt: REPLACE overwrites duplicate
+        # keys, INSERT IGNORE skips them. Falls back to executemany when the server or client refuses local infile;
+        # any other error is raised
+        col_list = list(col_list)
+        row_getter = operator.itemgetter(*col_list) if len(col_list) > 1 else lambda row: (row[col_list[0]],)
+        duplicates = 'REPLACE' if insert_type.upper().startswith('REPLACE') else 'IGNORE'
+        tsv = tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='utf8', newline='', delete=False)
+        try:
+            with tsv:
+                for row in data:
+                    values = row_getter(row) if isinstance(row, dict) else row
+                    tsv.write('\t'.join(map(self.tsv_value, values)) + '\n')
+            load_stmt = (f"LOAD DATA LOCAL INFILE %s {duplicates} INTO TABLE {table} CHARACTER SET utf8 "
+                         f"({', '.join(col_list)})")
+            try:
+                with MySQLPool.connection(local_infile=True) as connection:
+                    cursor = connection.cursor()
+                    cursor.execute(load_stmt, (tsv.name,))
+                    connection.commit()
+                    info, rowcount, warnings = connection.info(), cursor.rowcount, connection.warning_count()
+                    cursor.close()
+            except MySQLdb.Error as e:
+                if not e.args or e.args[0] not in self.local_infile_refused:
+                    raise
+                return self._bulk_load_fallback(table, tsv.name, insert_type, col_list)
+            report = {k.lower(): int(v) for k, v in re.findall(r'(\w+): (\d+)', info or '')}
+            return {'method': 'load_data', 'rows': report.get('records', rowcount), 'skipped': report.get('skipped', 0),
+                    'deleted': report.get('deleted', 0), 'warnings': report.get('warnings', warnings), 'failed': []}
+        finally:
+            os.remove(tsv.name)
+
+    def _bulk_load_fallback(self, table, tsv_path, insert_type, col_list):
+        # Replay the TSV written by bulk_load through executemany
+        unescape = {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0', '\\': '\\'}
+
+        def parse(field):
+            if field == '\\N':
+                return None
+            return re.sub(r'\\(.)', lambda m: unescape.get(m.group(1), m.group(1)), field)
+
+        stmt = self.create_stmt(table, insert_type, col_list)
+        with open(tsv_path, encoding='utf8', newline='') as tsv:
+            rows = (dict(zip(col_list, map(parse, line.rstrip('\n').split('\t')))) for line in tsv)
+            report = self.insert_data(stmt, rows)
+        return {'method': 'executemany', 'rows': report['rows'], 'skipped': 0, 'deleted': 0,
+                'warnings': self.connection.warning_count(), 'failed': report['failed']}
+
+    def insert_data(self, stmt, data, rows_per_statement=1000, rows_per_commit=10000, progress=None):
+        # Insert data into table in chunks of rows_per_statement, which executemany packs into one multi-row
+        # VALUES statement, committing every rows_per_commit rows. A failing chunk is bisected until the bad rows
+        # are isolated, so the good rows still land. progress(rows_done, rows_total) is called after each chunk.
+        # Returns {'rows': inserted, 'failed': [{'row', 'error'}]}. A non-data error rolls back the uncommitted
+        # rows and is raised; everything committed before it stays
+        logger = logging.getLogger(__name__)
+        total = len(data) if hasattr(data, '__len__') else None
+        rows = iter(data)
+        report = {'rows': 0, 'failed': []}
+        done = uncommitted = committed = 0
         try:
-            self.cursor.executemany(stmt, data)
+            for chunk in iter(lambda: list(itertools.islice(rows, rows_per_statement)), []):
+                report['rows'] += self._insert_chunk(stmt, chunk, report['failed'])
+                done += len(chunk)
+                uncommitted += len(chunk)
+                if uncommitted >= rows_per_commit:
+                    self.connection.commit()
+                    committed, uncommitted = done, 0
+                    logger.info('%s: committed %s/%s rows', stmt.split(' (')[0], done, total or '?')
+                if progress:
+                    progress(done, total)
             self.connection.commit()
-        except Exception as e:
+        except Exception:
+            logger.error('%s: aborted, rows after the first %s were rolled back', stmt.split(' (')[0], committed)
+            try:
+                self.connection.rollback()
+            except Exception:
+                pass
+            raise
+        if report['failed']:
+            logger.warning('%s: %s of %s rows rejected, first error: %s', stmt.split(' (')[0],
+                           len(report['failed']), done, report['failed'][0]['error'])
+        return report
+
+    def _insert_chunk(self, stmt, chunk, failed):
+        # Insert a chunk, splitting it in half on a data error until single bad rows are left; returns rows
+        # inserted. Errors about the row data itself (constraint, value or, client side, a missing or unformattable
+        # key) are bisected. Anything else is raised instead: ProgrammingError for the statement (missing table,
+        # syntax, commands out of sync) and OperationalError for a lost connection, lock wait timeout or deadlock
+        # (which rolls back the open transaction)
+        try:
+            self.cursor.executemany(stmt, chunk)
+            return len(chunk)
+        except (MySQLdb.IntegrityError, MySQLdb.DataError, KeyError, TypeError) as e:
+            if len(chunk) == 1:
+                failed.append({'row': chunk[0], 'error': repr(e)})
+                return 0
+        middle = len(chunk) // 2
+        return self._insert_chunk(stmt, chunk[:middle], failed) + self._insert_chunk(stmt, chunk[middle:], failed)
+
+
+class EtlAuditLog(object):
+    # Process-wide buffer for sn.etl_audit_log records. Records are written in one multi-row insert once max_records
+    # are queued, when a record arrives flush_interval seconds after the last flush, and at process exit. A batch
+    # that cannot be written is appended to spill_file and replayed by the next flush in any process, so logging
+    # never fails a pipeline. After a failed write, flushes spill straight to the file for retry_interval seconds
+    # instead of waiting on the DW again. The audit table has no room for stage timing and row counts, so every
+    # record is also appended with them to the stats_file JSONL log, which is rotated to stats_file.1 once it grows
+    # past stats_max_bytes
+    insert_stmt = "INSERT INTO sn.etl_audit_log VALUES (null, %s, %s, %s, %s, null)"
+    max_records = int(os.environ.get('ETL_AUDIT_MAX_RECORDS', 100))
+    flush_interval = int(os.environ.get('ETL_AUDIT_FLUSH_INTERVAL', 60))
+    checkout_timeout = 5
+    spill_file = os.environ.get('ETL_AUDIT_SPILL_FILE', os.path.join(tempfile.gettempdir(), 'etl_audit_log.jsonl'))
+    stats_file = os.environ.get('ETL_AUDIT_STATS_FILE', os.path.join(tempfile.gettempdir(), 'etl_audit_stats.jsonl'))
+    stats_max_bytes = int(os.environ.get('ETL_AUDIT_STATS_MAX_BYTES', 16 * 1024 * 1024))
+    retry_interval = int(os.environ.get('ETL_AUDIT_RETRY_INTERVAL', 300))
+    _retry_at = 0
+    _lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _records = []
+    _last_flush = time.time()
+    _registered = False
+
+    @classmethod
+    def log(cls, etl_process, source, target, max_date=None, rows=None, seconds=None):
+        # Queue one audit record, flushing if the buffer is full or the flush interval has passed
+        record = {'etl_process': etl_process, 'source': source, 'target': target,
+                  'max_date': MySQLRpts.convert_datetime(max_date) if max_date else None,
+                  'rows': rows, 'seconds': round(seconds, 3) if seconds is not None else None,
+                  'logged_at': time.time()}
+        with cls._lock:
+            cls._records.append(record)
+            if not cls._registered:
+                atexit.register(cls.flush)
+                cls._registered = True
+            due = len(cls._records) >= cls.max_records or time.time() - cls._last_flush >= cls.flush_interval
+        if due:
+            cls.flush()
+
+    @classmethod
+    @contextlib.contextmanager
+    def stage(cls, etl_process, source, target):
+        # Time a pipeline stage and log it on exit; set stage['rows'] and stage['max_date'] inside the block
+        stage = {'rows': None, 'max_date': None}
+        started = time.time()
+        yield stage
+        cls.log(etl_process, source, target, max_date=stage['max_date'], rows=stage['rows'],
+                seconds=time.time() - started)
+
+    @classmethod
+    def flush(cls):
+        # Write spilled and buffered records; returns the number written
+        with cls._flush_lock:
+            with cls._lock:
+                records, cls._records = cls._records, []
+                cls._last_flush = time.time()
+            cls._append(cls.stats_file, records)
+            cls._rotate(cls.stats_file, cls.stats_max_bytes)
+            if time.time() < cls._retry_at:
+                cls._append(cls.spill_file, records)
+                return 0
+            claimed = cls._claim_spill()
+            spilled = [record for path in claimed for record in cls._read_records(path)]
+            if not records and not spilled:
+                return 0
+            try:
+                with MySQLPool.connection(cls.checkout_timeout) as connection:
+                    cursor = connection.cursor()
+                    cursor.executemany(cls.insert_stmt, [
+                        (r['etl_process'], r['source'], r['target'], r['max_date']) for r in spilled + records])
+                    connection.commit()
+                    cursor.close()
+                written = len(spilled) + len(records)
+            except Exception as e:
+                cls._retry_at = time.time() + cls.retry_interval
+                logging.getLogger(__name__).warning(
+                    'etl_audit_log unreachable, spilling %s records to %s until the retry in %ss: %r',
+                    len(spilled) + len(records), cls.spill_file, cls.retry_interval, e)
+                cls._append(cls.spill_file, spilled + records)
+                written = 0
+            for path in claimed:
+                os.remove(path)
+            return written
+
+    @classmethod
+    def _claim_spill(cls):
+        # Atomically rename the shared spill file, and replay files orphaned by dead processes, to names owned by
+        # this process, so concurrent flushes never replay or delete each other's records
+        claimed = []
+        candidates = [cls.spill_file] + sorted(glob.glob(glob.escape(cls.spill_file) + '.*.replay'))
+        for n, path in enumerate(candidates):
+            if path != cls.spill_file and cls._pid_alive(int(path[len(cls.spill_file) + 1:].split('.')[0])):
+                continue
+            target = f'{cls.spill_file}.{os.getpid()}.{time.time_ns()}.{n}.replay'
+            try:
+                os.rename(path, target)
+                claimed.append(target)
+            except OSError:
+                pass
+        return claimed
+
+    @staticmethod
+    def _pid_alive(pid):
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+
+    @staticmethod
+    def _read_records(path):
+        # Read JSON lines, skipping a line truncated by a crash mid-write
+        records = []
+        try:
+            with open(path, encoding='utf8') as lines:
+                for line in lines:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except OSError:
             pass
+        return records
+
+    @staticmethod
+    def _rotate(path, max_bytes):
+        # Move a log that has grown past max_bytes to path.1, replacing the previous one
+        try:
+            if os.path.getsize(path) > max_bytes:
+                os.replace(path, path + '.1')
+        except OSError:
+            pass
+
+    @staticmethod
+    def _append(path, records):
+        # Append records as JSON lines in a single write, so appends from concurrent processes do not interleave
+        if not records:
+            return
+        try:
+            with open(path, 'a', encoding='utf8') as log_file:
+                log_file.write(''.join(json.dumps(r) + '\n' for r in records))
+        except OSError:
+            pass
+
+
+class AsyncMySQLRpts(object):
+    # Asyncio counterpart of MySQLRpts with the same surface. Each call checks out a pooled connection on an executor
+    # thread, so DW reads and writes overlap with Salesforce or DynamoDB I/O awaited in the same event loop
+    def __init__(self, executor=None):
+        self.executor = executor
+
+    async def _run(self, method, *args, **kwargs):
+        def call():
+            with MySQLRpts() as mysql:
+                return getattr(mysql, method)(*args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def etl_log(self, etl_process, source, target, max_date=None, rows=None, seconds=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: EtlAuditLog.log(etl_process, source, target, max_date, rows, seconds))
+
+    async def exec_simple(self, stmt):
+        return await self._run('exec_simple', stmt)
+
+    async def get_select_data(self, stmt, output='dicts'):
+        return await self._run('get_select_data', stmt, output=output)
+
+    async def get_proc_data(self, proc_name, args=(), output='dicts'):
+        return await self._run('get_proc_data', proc_name, args, output=output)
+
+    async def insert_data(self, stmt, data, rows_per_statement=1000, rows_per_commit=10000, progress=None):
+        return await self._run('insert_data', stmt, data, rows_per_statement=rows_per_statement,
+                               rows_per_commit=rows_per_commit, progress=progress)
+
+    async def bulk_load(self, table, data, insert_type='INSERT IGNORE', col_list=[]):
+        return await self._run('bulk_load', table, data, insert_type=insert_type, col_list=col_list)
+
+    async def iter_select_data(self, stmt, batch_size=None, fetch_size=1000):
+        # Async generator over MySQLRpts.iter_select_data; each fetch runs on the executor, and the connection goes
+        # back to the pool when iteration ends or the generator is closed
+        loop = asyncio.get_running_loop()
+        mysql = await loop.run_in_executor(self.executor, MySQLRpts)
+        batches = mysql.iter_select_data(stmt, batch_size=batch_size or fetch_size)
+        done = object()
+        try:
+            while True:
+                batch = await loop.run_in_executor(self.executor, next, batches, done)
+                if batch is done:
+                    break
+                if batch_size:
+                    yield batch
+                else:
+                    for row in batch:
+                        yield row
         finally:
-            del self
\ No newline at end of file
+            await loop.run_in_executor(self.executor, lambda: (batches.close(), mysql.close()))